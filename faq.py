@@ -0,0 +1,85 @@
+import argparse
+import asyncio
+from typing import List
+
+from tqdm.asyncio import tqdm_asyncio
+
+from providers.faq import faq_path, load_faq, normalize_question, save_faq, source_hashes
+from providers.ollama import answer_question, get_shop, retrieve_documents, shop_configs
+from providers.shops import DEFAULT_SHOP
+
+
+# Сколько вопросов обрабатывается одновременно (генерация упирается в Ollama)
+CONCURRENCY = 4
+QUESTIONS_PATH = "data/faq_questions.txt"
+
+
+def read_questions(path: str) -> List[str]:
+    """
+    One question per line; empty lines and duplicates (after normalization) are skipped.
+    """
+    questions = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            question = line.strip()
+            if question:
+                questions.setdefault(normalize_question(question), question)
+    return list(questions.values())
+
+
+async def precompute_answers(shop_id: str, questions: List[str], concurrency: int = CONCURRENCY, force: bool = False):
+    """
+    Answer every question with retrieval + generation and store the answers with
+    their source chunk hashes and the index version. After a re-ingest only the
+    entries whose retrieved chunks changed are regenerated.
+    """
+    shop = get_shop(shop_id)
+    path = faq_path(shop_configs[shop_id])
+    existing = load_faq(path)
+    semaphore = asyncio.Semaphore(concurrency)
+    stats = {"generated": 0, "kept": 0, "failed": 0}
+
+    async def process(question: str):
+        key = normalize_question(question)
+        entry = existing.get(key)
+        if not force and entry and entry.get("index_version") == shop.index_version:
+            stats["kept"] += 1
+            return key, entry
+
+        async with semaphore:
+            try:
+                docs = await asyncio.to_thread(retrieve_documents, shop, question, None, None)
+                hashes = source_hashes(docs)
+                if not force and entry and entry.get("source_hashes") == hashes:
+                    stats["kept"] += 1
+                    return key, {**entry, "index_version": shop.index_version}
+
+                answer = await asyncio.to_thread(answer_question, shop, question, docs)
+            except Exception as e:
+                print(f"Не удалось получить ответ на вопрос '{question}': {e}")
+                stats["failed"] += 1
+                # Старый ответ оставляем: сервер не отдаст его, пока версия индекса не совпадет
+                return key, entry
+
+        stats["generated"] += 1
+        return key, {
+            "question": question,
+            "answer": answer,
+            "source_hashes": hashes,
+            "index_version": shop.index_version,
+        }
+
+    results = await tqdm_asyncio.gather(*[process(q) for q in questions], desc="Ответы на частые вопросы")
+    save_faq(path, {key: entry for key, entry in results if entry is not None})
+    print(f"Сгенерировано: {stats['generated']}, без изменений: {stats['kept']}, ошибок: {stats['failed']}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute answers for frequent questions.")
+    parser.add_argument("questions", nargs="?", default=QUESTIONS_PATH, help="file with one question per line")
+    parser.add_argument("--shop", default=DEFAULT_SHOP)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--force", action="store_true", help="regenerate every answer")
+    args = parser.parse_args()
+
+    asyncio.run(precompute_answers(args.shop, read_questions(args.questions), args.concurrency, args.force))
@@ -1,19 +1,59 @@
+import argparse
 import hashlib
 import os
+import pickle
 import shutil
-from typing import List
+from typing import List, Optional
 from tqdm import tqdm
 
+import faiss
+import numpy as np
+
 from langchain_community.document_loaders import TextLoader
 from langchain.text_splitter import MarkdownTextSplitter
 from langchain.schema import Document
 from langchain_community.vectorstores import FAISS
 from langchain_ollama import OllamaEmbeddings
 
+from providers.metadata_index import build_metadata_index, load_product_metadata, save_metadata_index
+from providers.shops import write_manifest
+from providers.snippets import chunk_span, write_snippet_store
+
 
 # Путь к директории для сохранения базы FAISS
 FAISS_PATH = "./db_faiss_v1"
 DATA_PATH = "./docs"
+# Must match the shop's embedding_model in shops.json: queries are embedded with that model
+EMBEDDING_MODEL = "mxbai-embed-large"
+
+# Vector storage: "none" (float32), "fp16" or "int8" scalar quantization
+INDEX_QUANTIZATION = "none"
+# Reduce the 1024-dim embeddings before storing: None keeps all dimensions
+INDEX_DIM = None
+# "truncate" keeps the first INDEX_DIM dimensions (mxbai-embed-large is Matryoshka-trained), "pca" projects
+INDEX_REDUCTION = "truncate"
+# Prefilter candidates by Hamming distance on sign bits, then rescore them with the stored vectors
+INDEX_BINARY_PREFILTER = False
+# How many binary candidates are rescored per requested result
+BINARY_RESCORE_FACTOR = 8
+
+# Keep each source document once in a compressed blob and store chunks as spans into it
+SNIPPET_STORE = True
+
+# Compression report: number of chunks used as queries and results compared per query
+REPORT_QUERIES = 200
+REPORT_K = 4
+REPORT_CONFIGS = [
+    ("none", None, "truncate", False),
+    ("fp16", None, "truncate", False),
+    ("int8", None, "truncate", False),
+    ("fp16", 512, "truncate", False),
+    ("int8", 512, "truncate", False),
+    ("int8", 256, "truncate", False),
+    ("int8", 256, "pca", False),
+    ("fp16", None, "truncate", True),
+    ("int8", 512, "truncate", True),
+]
 global_unique_hashes = set()
 
 
@@ -26,14 +66,19 @@ def walk_through_files(path, file_extension='.txt'):
 
 def load_documents():
     """
-    Load documents from the specified directory
+    Load documents from the specified directory.
+    Product metadata from the export (product_N.json next to product_N.txt)
+    is attached to each document so it survives splitting into chunks.
     Returns:
     List of Document objects:
     """
     documents = []
     for f_name in walk_through_files(DATA_PATH):
         document_loader = TextLoader(f_name, encoding="utf-8")
-        documents.extend(document_loader.load())
+        metadata = load_product_metadata(os.path.splitext(f_name)[0] + ".json")
+        for document in document_loader.load():
+            document.metadata.update(metadata)
+            documents.append(document)
 
     return documents
 
@@ -56,6 +101,7 @@ def split_text(documents: List[Document]):
         chunk_size=500,  # Size of each chunk in characters
         chunk_overlap=100,  # Overlap between consecutive chunks
         length_function=len,  # Function to compute the length of the text
+        add_start_index=True,  # Offset of each chunk in its document, used for snippet spans
     )
 
     # Split documents into smaller chunks using text splitter
@@ -67,6 +113,8 @@ def split_text(documents: List[Document]):
     for chunk in chunks:
         chunk_hash = hash_text(chunk.page_content)
         if chunk_hash not in global_unique_hashes:
+            # Lets precomputed answers detect when their source chunks change
+            chunk.metadata["chunk_hash"] = chunk_hash
             unique_chunks.append(chunk)
             global_unique_hashes.add(chunk_hash)
 
@@ -75,51 +123,202 @@ def split_text(documents: List[Document]):
     return unique_chunks  # Return the list of split text chunks
 
 
-def save_to_faiss(chunks: List[Document]):
+def _reduction_chain(d: int, dim: Optional[int], reduction: str) -> list:
+    """
+    Vector transforms applied to both stored and query vectors before quantization.
+    """
+    if not dim or dim >= d:
+        return []
+    if reduction == "pca":
+        return [faiss.PCAMatrix(d, dim)]
+    # Matryoshka truncation: keep the leading dimensions and renormalize
+    return [faiss.RemapDimensionsTransform(d, dim, False), faiss.NormalizationTransform(dim, 2.0)]
+
+
+def _with_chain(chain: list, index):
+    if not chain:
+        return index
+    index = faiss.IndexPreTransform(index)
+    for transform in reversed(chain):
+        index.prepend_transform(transform)
+    return index
+
+
+def build_index(vectors: np.ndarray, quantization: str = INDEX_QUANTIZATION, dim: Optional[int] = INDEX_DIM,
+                reduction: str = INDEX_REDUCTION, binary_prefilter: bool = INDEX_BINARY_PREFILTER):
+    """
+    Build a (possibly compressed) FAISS index over the given embeddings.
+    Positions in the returned index match the row order of `vectors`.
+    """
+    d = vectors.shape[1]
+    chain = _reduction_chain(d, dim, reduction)
+    stored_dim = dim if chain else d
+
+    if quantization == "fp16":
+        storage = faiss.IndexScalarQuantizer(stored_dim, faiss.ScalarQuantizer.QT_fp16)
+    elif quantization == "int8":
+        storage = faiss.IndexScalarQuantizer(stored_dim, faiss.ScalarQuantizer.QT_8bit)
+    else:
+        storage = faiss.IndexFlatL2(stored_dim)
+    index = _with_chain(chain, storage)
+
+    if binary_prefilter:
+        # One bit per dimension (sign), no rotation: Hamming search over packed codes
+        binary = _with_chain(chain, faiss.IndexLSH(stored_dim, stored_dim, False, False))
+        index = faiss.IndexRefine(binary, index)
+        index.k_factor = BINARY_RESCORE_FACTOR
+
+    index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def _index_bytes(index) -> int:
+    return faiss.serialize_index(index).nbytes
+
+
+def compression_report(db, vectors: np.ndarray):
+    """
+    Print memory used versus recall lost for each configuration in REPORT_CONFIGS.
+    Recall@REPORT_K is measured against the exact float32 index, using a sample of
+    our own chunks as queries (each query's own chunk is excluded from both result lists).
+    """
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(vectors), size=min(REPORT_QUERIES, len(vectors)), replace=False)
+    queries = vectors[sample]
+    k = min(REPORT_K + 1, len(vectors))
+
+    def neighbours(index):
+        _, found = index.search(queries, k)
+        return [set(row[row != own].tolist()[:REPORT_K]) for row, own in zip(found, sample)]
+
+    exact = build_index(vectors, "none", None)
+    expected = neighbours(exact)
+    baseline_bytes = _index_bytes(exact)
+    docstore_bytes = len(pickle.dumps((db.docstore, db.index_to_docstore_id)))
+
+    print(f"\nCompression report: {len(vectors)} vectors, {len(sample)} queries, recall@{REPORT_K}")
+    print(f"Docstore (pickled): {docstore_bytes / 2**20:.1f} MiB")
+    print(f"{'quantization':<13}{'dim':>6}  {'reduction':<10}{'binary':<8}{'index MiB':>10}{'saved':>8}{'recall':>8}")
+    for quantization, dim, reduction, binary_prefilter in REPORT_CONFIGS:
+        if reduction == "pca" and dim and len(vectors) < dim:
+            print(f"{quantization:<13}{dim:>6}  {reduction:<10}{'skipped: not enough vectors to train PCA'}")
+            continue
+        index = build_index(vectors, quantization, dim, reduction, binary_prefilter)
+        found = neighbours(index)
+        recall = np.mean([len(e & f) / max(len(e), 1) for e, f in zip(expected, found)])
+        size = _index_bytes(index)
+        print(f"{quantization:<13}{dim or vectors.shape[1]:>6}  {reduction if dim else '-':<10}"
+              f"{'yes' if binary_prefilter else 'no':<8}{size / 2**20:>10.1f}"
+              f"{1 - size / baseline_bytes:>8.0%}{recall:>8.3f}")
+
+
+def attach_spans(documents: List[Document], chunks: List[Document]) -> List[str]:
+    """
+    Write the source documents to the snippet store and point each chunk at its span.
+    Returns the text to keep in the docstore for each chunk: empty when the chunk
+    is served from the snippet store.
+    """
+    doc_ids = write_snippet_store(FAISS_PATH, documents)
+    by_source = {document.metadata.get("source"): document for document in documents}
+    texts = []
+    for chunk in chunks:
+        source = chunk.metadata.get("source")
+        span = chunk_span(by_source[source], chunk) if source in by_source else None
+        chunk.metadata.pop("start_index", None)
+        if span is None:
+            texts.append(chunk.page_content)
+        else:
+            chunk.metadata["span"] = [doc_ids[source]] + span
+            texts.append("")
+    print(f"Stored {len(doc_ids)} source documents, {texts.count('')} chunks as spans.")
+    return texts
+
+
+def save_to_faiss(chunks: List[Document], documents: Optional[List[Document]] = None,
+                  quantization: str = INDEX_QUANTIZATION, dim: Optional[int] = INDEX_DIM,
+                  reduction: str = INDEX_REDUCTION, binary_prefilter: bool = INDEX_BINARY_PREFILTER,
+                  report: bool = False, embedding_model: str = EMBEDDING_MODEL):
     """
     Save the given list of Document objects to a FAISS database with a progress bar.
+    Embeddings are stored with the requested quantization / dimension reduction.
+    When the source documents are given, chunk text goes to the snippet store instead of the docstore.
     """
+    if not chunks:
+        print("No chunks were processed to save.")
+        return
+
     # Clear out the existing database directory if it exists
     if os.path.exists(FAISS_PATH):
         shutil.rmtree(FAISS_PATH)
 
     # Initialize the embedding function
-    embedding_function = OllamaEmbeddings(model="mxbai-embed-large")
+    embedding_function = OllamaEmbeddings(model=embedding_model)
 
     # Set a batch size for processing
     batch_size = 16
-    db = None
+    embeddings = []
 
     # Process chunks in batches with a progress bar
-    for i in tqdm(range(0, len(chunks), batch_size), desc="Generating embeddings and saving to FAISS"):
+    for i in tqdm(range(0, len(chunks), batch_size), desc="Generating embeddings"):
         batch = chunks[i:i+batch_size]
-        if not batch:
-            continue
-        
-        if db is None:
-            # Create the DB with the first batch
-            db = FAISS.from_documents(batch, embedding_function)
-        else:
-            # Add subsequent batches to the existing DB
-            db.add_documents(batch)
-            
-    # Persist the database to disk if it was created
-    if db:
-        db.save_local(FAISS_PATH)
-        print(f"\nSaved {len(chunks)} chunks to {FAISS_PATH}.")
-    else:
-        print("No chunks were processed to save.")
+        embeddings.extend(embedding_function.embed_documents([chunk.page_content for chunk in batch]))
+
+    texts = [chunk.page_content for chunk in chunks]
+    if documents and SNIPPET_STORE:
+        texts = attach_spans(documents, chunks)
 
+    db = FAISS.from_embeddings(
+        list(zip(texts, embeddings)),
+        embedding_function,
+        metadatas=[chunk.metadata for chunk in chunks],
+    )
+    vectors = np.array(embeddings, dtype=np.float32)
+
+    if report:
+        compression_report(db, vectors)
+
+    # Replace the default float32 flat index; positions stay the same, so the docstore mapping is unchanged
+    if quantization != "none" or dim or binary_prefilter:
+        db.index = build_index(vectors, quantization, dim, reduction, binary_prefilter)
 
-def generate_data_store():
+    # Persist the database to disk
+    db.save_local(FAISS_PATH)
+    # Per-field bitmaps over FAISS positions for filtered retrieval
+    save_metadata_index(build_metadata_index(db), FAISS_PATH)
+    write_manifest(FAISS_PATH, [chunk.metadata["chunk_hash"] for chunk in chunks], embedding_model)
+    print(f"\nSaved {len(chunks)} chunks to {FAISS_PATH}.")
+
+
+def generate_data_store(**index_options):
     """
     Function to generate vector database in FAISS from documents.
     """
     documents = load_documents()  # Load documents from a source
     chunks = split_text(documents)  # Split documents into manageable chunks
-    save_to_faiss(chunks)  # Save the processed data to a data store
+    save_to_faiss(chunks, documents, **index_options)  # Save the processed data to a data store
 
 
 if __name__ == "__main__":
-    generate_data_store()
+    parser = argparse.ArgumentParser(description="Build the FAISS vector store from DATA_PATH.")
+    # One index per shop: point these at the shop's documents and its faiss_path from shops.json
+    parser.add_argument("--data-path", default=DATA_PATH)
+    parser.add_argument("--faiss-path", default=FAISS_PATH)
+    parser.add_argument("--embedding-model", default=EMBEDDING_MODEL)
+    parser.add_argument("--quantization", choices=["none", "fp16", "int8"], default=INDEX_QUANTIZATION)
+    parser.add_argument("--dim", type=int, default=INDEX_DIM, help="reduce embeddings to this many dimensions")
+    parser.add_argument("--reduction", choices=["truncate", "pca"], default=INDEX_REDUCTION)
+    parser.add_argument("--binary-prefilter", action="store_true", default=INDEX_BINARY_PREFILTER)
+    parser.add_argument("--report", action="store_true", help="print memory saved vs recall lost on this corpus")
+    args = parser.parse_args()
+    DATA_PATH = args.data_path
+    FAISS_PATH = args.faiss_path
 
+    generate_data_store(
+        quantization=args.quantization,
+        dim=args.dim,
+        reduction=args.reduction,
+        binary_prefilter=args.binary_prefilter,
+        embedding_model=args.embedding_model,
+        report=args.report,
+    )
@@ -1,9 +1,14 @@
+from typing import Optional
+
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.responses import StreamingResponse
 
 from models.index import ChatMessage
-from providers.ollama import stream_rag_query
+from providers.ollama import shop_configs, stream_rag_query
+from providers.shops import DEFAULT_SHOP
+from providers.streaming import STREAM_COMPRESSION, get_stream, gzip_frames, parse_event_id, sse_frames, text_frames
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
 
 
@@ -26,5 +31,33 @@ async def read_root():
 
 
 @app.post("/chat/{chat_id}")
-async def ask(chat_id: str, message: ChatMessage):
-    return {"response": stream_rag_query(message, chat_id)}
\ No newline at end of file
+async def ask(chat_id: str, message: ChatMessage, request: Request, shop: str = DEFAULT_SHOP,
+              last_event_id: Optional[str] = Header(None)):
+    if shop not in shop_configs:
+        raise HTTPException(status_code=404, detail=f"Unknown shop '{shop}'")
+
+    # Клиент переподключился после обрыва: дочитываем тот же ответ с места остановки
+    if last_event_id:
+        try:
+            stream_id, position = parse_event_id(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Malformed Last-Event-ID")
+        stream = get_stream(stream_id)
+        if stream is None or stream.owner != (shop, chat_id):
+            raise HTTPException(status_code=410, detail="Stream expired")
+    else:
+        stream, position = stream_rag_query(message, chat_id, shop), 0
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if "text/event-stream" in request.headers.get("accept", ""):
+        media_type = "text/event-stream"
+        body = sse_frames(stream, position)
+    else:
+        media_type = "text/plain; charset=utf-8"
+        body = text_frames(stream, position)
+
+    if STREAM_COMPRESSION and "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        body = gzip_frames(body)
+
+    return StreamingResponse(body, media_type=media_type, headers=headers)
@@ -1,5 +1,26 @@
+from typing import Optional
+
 from pydantic import BaseModel
 
 
+class ProductFilter(BaseModel):
+    category: Optional[str] = None
+    in_stock: Optional[bool] = None
+    price_min: Optional[float] = None
+    price_max: Optional[float] = None
+
+
 class ChatMessage(BaseModel):
-    question: str
\ No newline at end of file
+    question: str
+    filters: Optional[ProductFilter] = None
+
+
+class ShopConfig(BaseModel):
+    faiss_path: str
+    # None — системный промпт по умолчанию
+    system_prompt: Optional[str] = None
+    model: str = "tinyllama"
+    temperature: float = 0.1
+    embedding_model: str = "mxbai-embed-large"
+    # None — файл рядом с папкой индекса: <faiss_path>_faq.json
+    faq_path: Optional[str] = None
@@ -138,9 +138,14 @@ async def main():
             file_content = format_product_to_text(product)
             file_path = os.path.join(DIR_TO_STORE, f"product_{product_id}.txt")
             
+            # Исходная запись товара рядом с текстом: ingest берет из нее категории, остаток и цены
+            json_path = os.path.join(DIR_TO_STORE, f"product_{product_id}.json")
+
             try:
                 with open(file_path, "w", encoding="utf-8") as f:
                     f.write(file_content)
+                with open(json_path, "w", encoding="utf-8") as f:
+                    json.dump(product, f, ensure_ascii=False)
             except IOError as e:
                 print(f"Не удалось сохранить файл {file_path}: {e}")
 
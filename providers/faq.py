@@ -0,0 +1,54 @@
+import hashlib
+import json
+import os
+import re
+from typing import Dict, List
+
+from langchain_core.documents import Document
+
+from models.index import ShopConfig
+
+
+def normalize_question(question: str) -> str:
+    """
+    Key used to match an incoming question against the precomputed ones:
+    lowercase, without punctuation, with collapsed whitespace.
+    """
+    question = re.sub(r"[^\w\s]", " ", question.lower().replace("ё", "е"))
+    return " ".join(question.split())
+
+
+def faq_path(config: ShopConfig) -> str:
+    """
+    Where the shop's precomputed answers live. Kept outside the index folder:
+    ingest deletes that folder, and the answers must survive a re-ingest to be reused.
+    """
+    return config.faq_path or config.faiss_path.rstrip("/\\") + "_faq.json"
+
+
+def source_hashes(docs: List[Document]) -> List[str]:
+    """
+    Hashes of the chunks an answer was generated from (stamped by ingest, computed for older indexes).
+    """
+    return [
+        doc.metadata.get("chunk_hash") or hashlib.sha256(doc.page_content.encode()).hexdigest()
+        for doc in docs
+    ]
+
+
+def load_faq(path: str) -> Dict[str, dict]:
+    """
+    Read the precomputed answers: normalized question -> entry with
+    question, answer, source_hashes and index_version.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_faq(path: str, entries: Dict[str, dict]):
+    # Пишем во временный файл, чтобы сервер не прочитал наполовину записанный JSON
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(entries, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
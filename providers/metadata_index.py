@@ -0,0 +1,160 @@
+import json
+import os
+import pickle
+from collections import defaultdict
+from typing import Optional
+
+import faiss
+import numpy as np
+
+# Индекс метаданных хранится рядом с FAISS (index.faiss / index.pkl)
+METADATA_INDEX_FILE = "metadata_index.pkl"
+
+
+def load_product_metadata(path: str) -> dict:
+    """
+    Read the product export record stored next to a document (product_N.json for
+    product_N.txt, written by the export scraper) and normalize it into flat chunk metadata.
+    Returns an empty dict when there is no export for this document.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+
+    # Категории приходят либо строками, либо объектами {"id", "name", "slug"}
+    categories = raw.get("categories") or []
+    if isinstance(categories, (str, dict)):
+        categories = [categories]
+    names = [c.get("name", "") if isinstance(c, dict) else str(c) for c in categories]
+
+    stock = raw.get("stock_quantity")
+    stock = int(stock) if stock not in (None, "") else None
+
+    # Ценовые уровни {"quantity_from", "quantity_to", "price"}: для фильтра берем минимальную цену
+    prices = [tier.get("price") for tier in raw.get("prices") or []]
+    prices = [float(p) for p in prices if p not in (None, "", "N/A")]
+
+    return {
+        "categories": [name.strip().lower() for name in names if name.strip()],
+        "stock_quantity": stock,
+        "price": min(prices) if prices else None,
+    }
+
+
+def build_metadata_index(db) -> dict:
+    """
+    Build per-field bitmaps over FAISS positions from the chunk metadata of a vector store.
+    """
+    size = db.index.ntotal
+    categories = defaultdict(lambda: np.zeros(size, dtype=bool))
+    out_of_stock = np.zeros(size, dtype=bool)
+    prices = np.full(size, np.nan, dtype=np.float32)
+    # Поля, которые пришли из выгрузки хотя бы для одного чанка
+    fields = set()
+
+    for position, doc_id in db.index_to_docstore_id.items():
+        metadata = db.docstore.search(doc_id).metadata
+        for category in metadata.get("categories") or []:
+            categories[category][position] = True
+            fields.add("categories")
+        stock = metadata.get("stock_quantity")
+        if stock is not None:
+            fields.add("stock_quantity")
+            if stock <= 0:
+                out_of_stock[position] = True
+        if metadata.get("price") is not None:
+            prices[position] = metadata["price"]
+            fields.add("price")
+
+    return {
+        "size": size,
+        "categories": {name: np.packbits(bitmap) for name, bitmap in categories.items()},
+        "out_of_stock": np.packbits(out_of_stock),
+        "price": prices,
+        "fields": fields,
+    }
+
+
+def save_metadata_index(metadata_index: dict, folder_path: str):
+    with open(os.path.join(folder_path, METADATA_INDEX_FILE), "wb") as f:
+        pickle.dump(metadata_index, f)
+
+
+def load_metadata_index(folder_path: str) -> Optional[dict]:
+    """
+    Load the metadata index saved by ingest, unpacking the bitmaps once.
+    Returns None for indexes built before metadata was kept.
+    """
+    path = os.path.join(folder_path, METADATA_INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        metadata_index = pickle.load(f)
+
+    size = metadata_index["size"]
+    metadata_index["categories"] = {
+        name: np.unpackbits(bits, count=size).astype(bool)
+        for name, bits in metadata_index["categories"].items()
+    }
+    metadata_index["out_of_stock"] = np.unpackbits(metadata_index["out_of_stock"], count=size).astype(bool)
+    if "fields" not in metadata_index:
+        # Индексы без списка полей: восстанавливаем его по самим данным
+        metadata_index["fields"] = {
+            field for field, populated in (
+                ("categories", bool(metadata_index["categories"])),
+                ("stock_quantity", metadata_index["out_of_stock"].any()),
+                ("price", not np.isnan(metadata_index["price"]).all()),
+            ) if populated
+        }
+    return metadata_index
+
+
+def select_positions(metadata_index: dict, filters) -> Optional[np.ndarray]:
+    """
+    Intersect the bitmaps for the requested filters.
+    Returns the matching FAISS positions, or None when no filter applies.
+    Filters on fields that no chunk got at ingest are skipped with a warning:
+    they would otherwise match nothing and leave the model without context.
+    """
+    if filters is None:
+        return None
+    size = metadata_index["size"]
+    fields = metadata_index["fields"]
+    mask = None
+
+    def intersect(current, bitmap):
+        return bitmap.copy() if current is None else current & bitmap
+
+    requested = {
+        "categories": bool(filters.category),
+        "stock_quantity": filters.in_stock is not None,
+        "price": filters.price_min is not None or filters.price_max is not None,
+    }
+    missing = [field for field, is_set in requested.items() if is_set and field not in fields]
+    if missing:
+        print(f"Metadata fields {', '.join(missing)} were not populated at ingest, ignoring these filters.")
+
+    if filters.category and "categories" in fields:
+        bitmap = metadata_index["categories"].get(filters.category.strip().lower())
+        mask = intersect(mask, bitmap if bitmap is not None else np.zeros(size, dtype=bool))
+    if filters.in_stock is not None and "stock_quantity" in fields:
+        out_of_stock = metadata_index["out_of_stock"]
+        # Страницы без остатков (доставка, оплата) не считаются отсутствующими товарами
+        mask = intersect(mask, out_of_stock if filters.in_stock is False else ~out_of_stock)
+    # Сравнение с NaN дает False, так что товары без цены отсекаются ценовым фильтром
+    if filters.price_min is not None and "price" in fields:
+        mask = intersect(mask, metadata_index["price"] >= filters.price_min)
+    if filters.price_max is not None and "price" in fields:
+        mask = intersect(mask, metadata_index["price"] <= filters.price_max)
+
+    if mask is None:
+        return None
+    return np.flatnonzero(mask).astype(np.int64)
+
+
+def id_selector(positions: np.ndarray):
+    """
+    Wrap FAISS positions into an IDSelector usable in SearchParameters.
+    """
+    return faiss.IDSelectorBatch(len(positions), faiss.swig_ptr(positions))
@@ -1,34 +1,73 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import List, Optional
+
+import faiss
+import numpy as np
 from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.messages import HumanMessage, AIMessage
 from langchain_ollama import OllamaEmbeddings, OllamaLLM
 from langchain.chains.combine_documents import create_stuff_documents_chain
 
-from models.index import ChatMessage
+from models.index import ChatMessage, ProductFilter, ShopConfig
+from providers.faq import faq_path, load_faq, normalize_question
+from providers.metadata_index import id_selector, load_metadata_index, select_positions
+from providers.shops import DEFAULT_SHOP, ShopCache, index_size_on_disk, load_shop_configs, read_manifest
+from providers.snippets import load_snippet_store
+from providers.streaming import ResponseStream, start_stream
 
-FAISS_PATH = "/home/ai-chatbot/db_faiss_products_v1"
+try:
+    from sentence_transformers import CrossEncoder
+except ImportError:  # реранкинг необязателен, без пакета работаем по векторному порядку
+    CrossEncoder = None
 
-model = OllamaLLM(
-    model="tinyllama",
-    temperature=0.1,
-    stop=["\nHuman:", "User:", "[INST]", "Вопрос:"]
-)
+# Сколько документов попадает в контекст промпта
+RETRIEVAL_K = 4
+# Расширять найденные чанки окружающим текстом на столько байт с каждой стороны (0 — не расширять)
+CONTEXT_WIDEN_BYTES = 0
+
+# --- РЕРАНКИНГ ---
+# Из FAISS берется RERANK_FETCH_K кандидатов, затем их пересчитывает небольшой
+# кросс-энкодер на CPU, и в промпт попадают лучшие RETRIEVAL_K.
+RERANK_ENABLED = True
+# Многоязычная модель: тексты товаров и вопросы на русском
+RERANK_MODEL = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+# Чанк — до 500 символов, в 256 токенов он укладывается почти целиком
+RERANK_MAX_LENGTH = 256
+RERANK_FETCH_K = 12
+RERANK_BATCH_SIZE = 16
+# Бюджет на реранкинг в секундах. Если не успели — отдаем векторный порядок.
+# При старте модель прогревается полным пакетом; если он не укладывается в бюджет,
+# реранкинг в запросах отключается, чтобы не жечь CPU рядом с Ollama впустую.
+RERANK_TIMEOUT = 0.8
+RERANK_WORKERS = 2
+# Кэш оценок по ключу (вопрос, хэш чанка)
+RERANK_CACHE_SIZE = 10000
+# --- КОНЕЦ РЕРАНКИНГА ---
 
-embedding_function = OllamaEmbeddings(model="mxbai-embed-large")
-db = FAISS.load_local(FAISS_PATH, embedding_function, allow_dangerous_deserialization=True)
+STOP_SEQUENCES = ["\nHuman:", "User:", "[INST]", "Вопрос:"]
+SYSTEM_PROMPT = "Вы — ИИ-ассистент для интернет-магазина. Ваша задача — отвечать на вопросы пользователя, основываясь ИСКЛЮЧИТЕЛЬНО на предоставленном ниже тексте. Не используйте никакие другие знания. Будьте кратки и точны."
+
+# История хранится по ключу (магазин, сессия)
 chat_history = {}
 
 
-prompt_template = ChatPromptTemplate.from_messages(
-    [
-        (
-            "system",
-            "Вы — ИИ-ассистент для интернет-магазина. Ваша задача — отвечать на вопросы пользователя, основываясь ИСКЛЮЧИТЕЛЬНО на предоставленном ниже тексте. Не используйте никакие другие знания. Будьте кратки и точны."
-        ),
-        MessagesPlaceholder(variable_name="chat_history"),
-        (
-            "human",
-            """
+def build_prompt(system_prompt: str) -> ChatPromptTemplate:
+    return ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                system_prompt
+            ),
+            MessagesPlaceholder(variable_name="chat_history"),
+            (
+                "human",
+                """
 Контекст из базы данных:
 ---
 {context}
@@ -37,24 +76,236 @@ prompt_template = ChatPromptTemplate.from_messages(
 
 Вопрос: {question}
 """
-        ),
-    ]
+            ),
+        ]
+    )
+
+
+class Shop:
+    """
+    Everything opened for one storefront: its index, metadata bitmaps and generation chain.
+    """
+
+    def __init__(self, shop_id: str, config: ShopConfig):
+        self.shop_id = shop_id
+        self.embedding_function = OllamaEmbeddings(model=config.embedding_model)
+        self.db = FAISS.load_local(config.faiss_path, self.embedding_function, allow_dangerous_deserialization=True)
+        self.metadata_index = load_metadata_index(config.faiss_path)
+        self.snippets = load_snippet_store(config.faiss_path)
+        manifest = read_manifest(config.faiss_path)
+        self.index_version = manifest.get("index_version")
+        indexed_with = manifest.get("embedding_model")
+        if indexed_with and indexed_with != config.embedding_model:
+            print(f"Shop '{shop_id}': index was built with '{indexed_with}', "
+                  f"but queries use '{config.embedding_model}'. Rebuild with ingest.py --embedding-model.")
+        # Отдаем только ответы, посчитанные по текущей версии индекса
+        self.faq = {
+            key: entry for key, entry in load_faq(faq_path(config)).items()
+            if entry.get("index_version") == self.index_version
+        }
+
+        model = OllamaLLM(
+            model=config.model,
+            temperature=config.temperature,
+            stop=STOP_SEQUENCES
+        )
+        self.document_chain = create_stuff_documents_chain(
+            llm=model, prompt=build_prompt(config.system_prompt or SYSTEM_PROMPT)
+        )
+
+    def hydrate(self, docs: List[Document]) -> List[Document]:
+        """
+        Fill in chunk text from the snippet store (indexes built without it keep text in the docstore).
+        """
+        if self.snippets is None:
+            return docs
+        return [self.snippets.hydrate(doc) for doc in docs]
+
+
+shop_configs = load_shop_configs()
+
+
+def _open_shop(shop_id: str):
+    config = shop_configs[shop_id]
+    return Shop(shop_id, config), index_size_on_disk(config.faiss_path)
+
+
+# Индексы открываются при первом запросе и живут в LRU с лимитом памяти
+shops = ShopCache(_open_shop)
+
+
+def get_shop(shop_id: str = DEFAULT_SHOP) -> Shop:
+    """
+    Return the opened shop, loading its index on first use. Raises KeyError for unknown shops.
+    """
+    if shop_id not in shop_configs:
+        raise KeyError(shop_id)
+    return shops.get(shop_id)
+
+
+_reranker = None
+_rerank_within_budget = False
+_rerank_cache = OrderedDict()
+_rerank_cache_lock = threading.Lock()
+_rerank_pool = ThreadPoolExecutor(max_workers=RERANK_WORKERS, thread_name_prefix="rerank")
+
+
+def _chunk_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _warm_up_reranker():
+    """
+    Load the cross-encoder at startup and time one full batch of worst-case pairs,
+    so model loading never counts against a request's budget.
+    """
+    global _reranker, _rerank_within_budget
+    try:
+        reranker = CrossEncoder(RERANK_MODEL, device="cpu", max_length=RERANK_MAX_LENGTH)
+        pairs = [("вопрос о товаре", "товар " * RERANK_MAX_LENGTH)] * RERANK_FETCH_K
+        reranker.predict(pairs, batch_size=RERANK_BATCH_SIZE)  # первый прогон медленнее, не меряем
+        started = time.perf_counter()
+        reranker.predict(pairs, batch_size=RERANK_BATCH_SIZE)
+        elapsed = time.perf_counter() - started
+    except Exception as e:
+        print(f"Failed to load reranker {RERANK_MODEL}: {e}. Using vector order.")
+        return
+
+    _reranker = reranker
+    _rerank_within_budget = elapsed <= RERANK_TIMEOUT
+    if _rerank_within_budget:
+        print(f"Reranker ready: {RERANK_FETCH_K} pairs in {elapsed:.2f}s.")
+    else:
+        print(f"Reranker needs {elapsed:.2f}s for {RERANK_FETCH_K} pairs, over the {RERANK_TIMEOUT}s budget. "
+              f"Online rerank disabled; lower RERANK_FETCH_K/RERANK_MAX_LENGTH or raise RERANK_TIMEOUT.")
+
+
+_rerank_warmup = (
+    _rerank_pool.submit(_warm_up_reranker) if RERANK_ENABLED and CrossEncoder is not None else None
 )
 
-document_chain = create_stuff_documents_chain(llm=model, prompt=prompt_template)
+
+def _score_candidates(question: str, docs: List[Document]) -> List[float]:
+    """
+    Score (question, chunk) pairs with the cross-encoder, reusing cached scores.
+    Only the pairs missing from the cache are sent to the model, in one batched call.
+    """
+    keys = [(question, _chunk_hash(doc.page_content)) for doc in docs]
+    scores = [None] * len(docs)
+    missing = []
+    with _rerank_cache_lock:
+        for i, key in enumerate(keys):
+            if key in _rerank_cache:
+                _rerank_cache.move_to_end(key)
+                scores[i] = _rerank_cache[key]
+            else:
+                missing.append(i)
+
+    if missing:
+        predicted = _reranker.predict(
+            [(question, docs[i].page_content) for i in missing],
+            batch_size=RERANK_BATCH_SIZE,
+        )
+        with _rerank_cache_lock:
+            for i, score in zip(missing, predicted):
+                scores[i] = float(score)
+                _rerank_cache[keys[i]] = scores[i]
+            while len(_rerank_cache) > RERANK_CACHE_SIZE:
+                _rerank_cache.popitem(last=False)
+
+    return scores
 
 
-def stream_rag_query(message: ChatMessage, session_id: str = ""):
+def _filterable_index(index):
     """
-    Query a RAG system using streaming to provide faster perceived response times.
+    The binary prefilter (IndexLSH) does not support IDSelector, so filtered
+    searches go straight to the rescoring index. Filtered subsets are small anyway.
+    """
+    if isinstance(index, faiss.IndexRefine):
+        return faiss.downcast_index(index.refine_index)
+    return index
+
+
+def _vector_search(shop: Shop, question: str, k: int, filters: Optional[ProductFilter] = None) -> List[Document]:
+    """
+    Similarity search restricted to the chunks matching the metadata filters.
+    Filtering happens inside FAISS through an IDSelector, so the k slots are
+    filled only with matching chunks.
+    """
+    db = shop.db
+    if shop.metadata_index is None:
+        if filters is not None:
+            print("Metadata index not found, ignoring filters.")
+        return shop.hydrate(db.similarity_search(question, k=k))
+
+    positions = select_positions(shop.metadata_index, filters)
+    if positions is None:
+        return shop.hydrate(db.similarity_search(question, k=k))
+    if len(positions) == 0:
+        return []
+
+    embedding = np.array([shop.embedding_function.embed_query(question)], dtype=np.float32)
+    if db._normalize_L2:
+        faiss.normalize_L2(embedding)
+    selector = id_selector(positions)
+    params = faiss.SearchParameters(sel=selector)
+    _, found = _filterable_index(db.index).search(embedding, min(k, len(positions)), params=params)
+    return shop.hydrate([db.docstore.search(db.index_to_docstore_id[int(p)]) for p in found[0] if p != -1])
+
+
+def retrieve_documents(shop: Shop, question: str, filters: Optional[ProductFilter] = None,
+                       rerank_timeout: Optional[float] = RERANK_TIMEOUT) -> List[Document]:
+    """
+    Vector search, optionally followed by a cross-encoder rerank under a latency budget.
+    Falls back to the plain vector order when the reranker is unavailable, fails or is too slow.
+    Offline callers pass rerank_timeout=None to always wait for the rerank.
     """
-    if session_id not in chat_history:
-        chat_history[session_id] = []
-    
-    # ИЗМЕНЕНО: Возвращаемся к более простому и надежному ретриверу
-    retriever = db.as_retriever(search_kwargs={'k': 4})
-    
-    context_docs = retriever.invoke(message.question)
+    if _rerank_warmup is None:
+        return _vector_search(shop, question, RETRIEVAL_K, filters)
+    if rerank_timeout is None:
+        _rerank_warmup.result()
+    # Пока модель не прогрета (или не укладывается в бюджет), запросы идут без реранкинга
+    if _reranker is None or (rerank_timeout is not None and not _rerank_within_budget):
+        return _vector_search(shop, question, RETRIEVAL_K, filters)
+
+    candidates = _vector_search(shop, question, RERANK_FETCH_K, filters)
+    if len(candidates) <= RETRIEVAL_K:
+        return candidates
+
+    future = _rerank_pool.submit(_score_candidates, question, candidates)
+    try:
+        scores = future.result(timeout=rerank_timeout)
+    except FutureTimeoutError:
+        # Если задача еще в очереди — снимаем ее. Уже запущенная досчитает и заполнит кэш.
+        future.cancel()
+        print(f"Rerank exceeded {rerank_timeout}s budget, using vector order.")
+        return candidates[:RETRIEVAL_K]
+    except Exception as e:
+        print(f"Rerank failed: {e}. Using vector order.")
+        return candidates[:RETRIEVAL_K]
+
+    order = sorted(range(len(candidates)), key=lambda i: scores[i], reverse=True)
+    return [candidates[i] for i in order[:RETRIEVAL_K]]
+
+
+def generate_rag_tokens(message: ChatMessage, session_id: str = "", shop_id: str = DEFAULT_SHOP):
+    """
+    Retrieve context and yield the answer tokens as the model produces them.
+    """
+    shop = get_shop(shop_id)
+    history = list(chat_history.get((shop_id, session_id), []))
+
+    # Частый вопрос с готовым ответом: отдаем сразу, без поиска и генерации
+    if message.filters is None:
+        precomputed = shop.faq.get(normalize_question(message.question))
+        if precomputed is not None:
+            yield precomputed["answer"]
+            return
+
+    # ИЗМЕНЕНО: векторный поиск с переранжированием кросс-энкодером
+    context_docs = retrieve_documents(shop, message.question, message.filters)
+    if CONTEXT_WIDEN_BYTES and shop.snippets is not None:
+        context_docs = shop.snippets.widen(context_docs, CONTEXT_WIDEN_BYTES)
 
     # ИЗМЕНЕНО: Добавлено логирование для отладки.
     # Теперь в консоли будет видно, какой контекст получает модель.
@@ -69,17 +320,41 @@ def stream_rag_query(message: ChatMessage, session_id: str = ""):
             print(f"Content: {doc.page_content[:300]}...")
     print("-----------------------------------\n")
 
-    response_stream = document_chain.stream({
+    response_stream = shop.document_chain.stream({
         "context": context_docs,
         "question": message.question,
-        "chat_history": chat_history[session_id]
+        "chat_history": history
     })
 
-    full_response = ""
     for chunk in response_stream:
         yield chunk
-        full_response += chunk
 
-    chat_history[session_id].append(HumanMessage(content=message.question))
-    chat_history[session_id].append(AIMessage(content=full_response))
+
+def answer_question(shop: Shop, question: str, context_docs: List[Document]) -> str:
+    """
+    Generate a complete answer without chat history (used for precomputed FAQ answers).
+    """
+    return shop.document_chain.invoke({
+        "context": context_docs,
+        "question": question,
+        "chat_history": []
+    })
+
+
+def save_history(shop_id: str, session_id: str, question: str, answer: str):
+    history = chat_history.setdefault((shop_id, session_id), [])
+    history.append(HumanMessage(content=question))
+    history.append(AIMessage(content=answer))
+
+
+def stream_rag_query(message: ChatMessage, session_id: str = "", shop_id: str = DEFAULT_SHOP) -> ResponseStream:
+    """
+    Query a RAG system using streaming to provide faster perceived response times.
+    Generation runs in the background; the answer is added to the history once complete.
+    """
+    return start_stream(
+        (shop_id, session_id),
+        generate_rag_tokens(message, session_id, shop_id),
+        lambda answer: save_history(shop_id, session_id, message.question, answer),
+    )
 
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from models.index import ShopConfig
+
+# JSON вида {"shop_key": {"faiss_path": "...", "system_prompt": "...", "model": "..."}}
+SHOPS_CONFIG_PATH = "./shops.json"
+DEFAULT_SHOP = "default"
+# Индекс магазина по умолчанию (если его нет в SHOPS_CONFIG_PATH)
+DEFAULT_FAISS_PATH = "/home/ai-chatbot/db_faiss_products_v1"
+
+# Версия индекса, модель эмбеддингов и число чанков, записываются ingest.py
+MANIFEST_FILE = "manifest.json"
+
+# Суммарный объем открытых индексов (по размеру файлов на диске)
+SHOP_CACHE_MAX_BYTES = 4 * 1024 ** 3
+# Магазин без запросов дольше этого времени (сек) выгружается из памяти
+SHOP_IDLE_TTL = 30 * 60
+
+
+def load_shop_configs(path: str = SHOPS_CONFIG_PATH) -> Dict[str, ShopConfig]:
+    """
+    Read the shop -> index/prompt/model mapping. The default shop always exists.
+    """
+    configs = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            configs = {key: ShopConfig(**value) for key, value in json.load(f).items()}
+    configs.setdefault(DEFAULT_SHOP, ShopConfig(faiss_path=DEFAULT_FAISS_PATH))
+    return configs
+
+
+def write_manifest(folder_path: str, chunk_hashes: List[str], embedding_model: str):
+    """
+    Record the index version (a hash over the embedding model and the hashes of
+    all indexed chunks) and the model the documents were embedded with.
+    """
+    index_version = hashlib.sha256(
+        (embedding_model + "".join(sorted(chunk_hashes))).encode()
+    ).hexdigest()[:16]
+    with open(os.path.join(folder_path, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "index_version": index_version,
+            "embedding_model": embedding_model,
+            "chunks": len(chunk_hashes),
+        }, f)
+
+
+def read_manifest(folder_path: str) -> dict:
+    path = os.path.join(folder_path, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def index_size_on_disk(folder_path: str) -> int:
+    """
+    Size of the saved index files, used as an estimate of the memory an open index takes.
+    """
+    return sum(
+        os.path.getsize(os.path.join(folder_path, name))
+        for name in os.listdir(folder_path)
+        if os.path.isfile(os.path.join(folder_path, name))
+    )
+
+
+class ShopCache:
+    """
+    LRU of opened shops with a memory cap and idle eviction.
+    Shops are opened lazily by `loader`, which returns (shop, size_in_bytes).
+    """
+
+    def __init__(self, loader: Callable[[str], Tuple[object, int]],
+                 max_bytes: int = SHOP_CACHE_MAX_BYTES, idle_ttl: float = SHOP_IDLE_TTL):
+        self._loader = loader
+        self._max_bytes = max_bytes
+        self._idle_ttl = idle_ttl
+        # shop_id -> [shop, size, last_used]
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def _touch(self, shop_id: str):
+        entry = self._entries.get(shop_id)
+        if entry is None:
+            return None
+        self._entries.move_to_end(shop_id)
+        entry[2] = time.monotonic()
+        return entry[0]
+
+    def _evict(self, keep: str = None):
+        now = time.monotonic()
+        for shop_id, (_, _, last_used) in list(self._entries.items()):
+            if shop_id != keep and now - last_used > self._idle_ttl:
+                print(f"Evicting idle shop '{shop_id}'.")
+                del self._entries[shop_id]
+
+        total = sum(size for _, size, _ in self._entries.values())
+        for shop_id in list(self._entries):
+            if total <= self._max_bytes:
+                break
+            if shop_id == keep:
+                continue
+            print(f"Evicting shop '{shop_id}' to stay under the memory cap.")
+            total -= self._entries.pop(shop_id)[1]
+
+    def get(self, shop_id: str):
+        with self._lock:
+            # Запрошенный магазин не выгружаем: он снова активен
+            self._evict(keep=shop_id)
+            shop = self._touch(shop_id)
+            if shop is not None:
+                return shop
+            load_lock = self._loading.setdefault(shop_id, threading.Lock())
+
+        # Загружаем вне общего замка: остальные магазины обслуживаются параллельно,
+        # а повторные запросы к этому же магазину ждут одну загрузку.
+        with load_lock:
+            with self._lock:
+                shop = self._touch(shop_id)
+                if shop is not None:
+                    return shop
+
+            print(f"Loading shop '{shop_id}'...")
+            shop, size = self._loader(shop_id)
+
+            with self._lock:
+                self._entries[shop_id] = [shop, size, time.monotonic()]
+                self._loading.pop(shop_id, None)
+                self._evict(keep=shop_id)
+            return shop
@@ -0,0 +1,156 @@
+import json
+import mmap
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from langchain_core.documents import Document
+
+# Исходные документы лежат один раз в SNIPPETS_FILE, таблица смещений — в SNIPPETS_TABLE_FILE.
+# Чанки в docstore хранят только span = [doc_id, start, end] (байтовые смещения в UTF-8).
+SNIPPETS_FILE = "sources.blob"
+SNIPPETS_TABLE_FILE = "sources.json"
+# Уровень zlib для каждого документа; 0 — хранить как есть (тогда срез читается прямо из mmap)
+SNIPPET_COMPRESSION = 6
+# Сколько распакованных документов держать в памяти
+SNIPPET_CACHE_DOCS = 256
+
+
+def write_snippet_store(folder_path: str, documents: List[Document], level: int = SNIPPET_COMPRESSION) -> Dict[str, int]:
+    """
+    Write every source document once into an offset-addressed blob file.
+    Returns source -> doc_id for attaching spans to chunks.
+    """
+    os.makedirs(folder_path, exist_ok=True)
+    doc_ids = {}
+    table = []
+    offset = 0
+    with open(os.path.join(folder_path, SNIPPETS_FILE), "wb") as f:
+        for document in documents:
+            source = document.metadata.get("source")
+            if source in doc_ids:
+                continue
+            data = document.page_content.encode()
+            block = zlib.compress(data, level) if level else data
+            f.write(block)
+            doc_ids[source] = len(table)
+            # [смещение, длина блока, длина исходного текста в байтах, сжат ли блок]
+            table.append([offset, len(block), len(data), bool(level)])
+            offset += len(block)
+
+    with open(os.path.join(folder_path, SNIPPETS_TABLE_FILE), "w", encoding="utf-8") as f:
+        json.dump({"documents": table}, f)
+    return doc_ids
+
+
+def chunk_span(document: Document, chunk: Document) -> Optional[List[int]]:
+    """
+    Byte span of a chunk inside its source document, from the splitter's start_index.
+    Returns None when the chunk text can't be located exactly.
+    """
+    start = chunk.metadata.get("start_index", -1)
+    text = document.page_content
+    if start < 0 or text[start:start + len(chunk.page_content)] != chunk.page_content:
+        return None
+    start_bytes = len(text[:start].encode())
+    return [start_bytes, start_bytes + len(chunk.page_content.encode())]
+
+
+class SnippetStore:
+    """
+    Read-only view over the blob file. Chunk text is sliced from the mmap
+    (after decompressing the source document once, if it was stored compressed).
+    """
+
+    def __init__(self, folder_path: str):
+        with open(os.path.join(folder_path, SNIPPETS_TABLE_FILE), "r", encoding="utf-8") as f:
+            self._table = json.load(f)["documents"]
+        self._file = open(os.path.join(folder_path, SNIPPETS_FILE), "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._view = memoryview(mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)) if size else memoryview(b"")
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _document(self, doc_id: int) -> memoryview:
+        offset, length, _, compressed = self._table[doc_id]
+        block = self._view[offset:offset + length]
+        if not compressed:
+            return block
+        with self._lock:
+            if doc_id in self._cache:
+                self._cache.move_to_end(doc_id)
+                return self._cache[doc_id]
+        data = memoryview(zlib.decompress(block))
+        with self._lock:
+            self._cache[doc_id] = data
+            while len(self._cache) > SNIPPET_CACHE_DOCS:
+                self._cache.popitem(last=False)
+        return data
+
+    def text(self, doc_id: int, start: int, end: int) -> str:
+        return str(self._document(doc_id)[start:end], "utf-8")
+
+    def hydrate(self, doc: Document) -> Document:
+        """
+        Return the chunk with its text filled in. The docstore entry itself stays empty.
+        """
+        span = doc.metadata.get("span")
+        if span is None or doc.page_content:
+            return doc
+        return Document(page_content=self.text(*span), metadata=doc.metadata)
+
+    def widen(self, docs: List[Document], margin: int) -> List[Document]:
+        """
+        Extend each hit by `margin` bytes of surrounding text on both sides.
+        Overlapping hits from the same source are merged so no text is repeated.
+        Sources keep the order of their first hit; hits without a span stay in place.
+        """
+        order = []
+        spans = {}
+        for doc in docs:
+            span = doc.metadata.get("span")
+            if span is None:
+                order.append((None, doc))
+                continue
+            doc_id, start, end = span
+            data = self._document(doc_id)
+            start, end = self._align(data, max(0, start - margin)), self._align(data, min(len(data), end + margin))
+            if doc_id not in spans:
+                spans[doc_id] = []
+                order.append((doc_id, doc.metadata))
+            spans[doc_id].append((start, end))
+
+        widened = []
+        for doc_id, item in order:
+            if doc_id is None:
+                widened.append(item)
+                continue
+            merged = []
+            for start, end in sorted(spans[doc_id]):
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            widened.extend(
+                Document(page_content=self.text(doc_id, start, end), metadata=item)
+                for start, end in merged
+            )
+        return widened
+
+    @staticmethod
+    def _align(data: memoryview, position: int) -> int:
+        # Не режем многобайтовый символ UTF-8: отступаем к началу символа
+        while 0 < position < len(data) and data[position] & 0xC0 == 0x80:
+            position -= 1
+        return position
+
+
+def load_snippet_store(folder_path: str) -> Optional[SnippetStore]:
+    """
+    Open the snippet store saved by ingest. Returns None for indexes that keep chunk text in the docstore.
+    """
+    if not os.path.exists(os.path.join(folder_path, SNIPPETS_TABLE_FILE)):
+        return None
+    return SnippetStore(folder_path)
@@ -0,0 +1,187 @@
+import asyncio
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterable, Optional, Tuple
+
+# Токены склеиваются в кадр, пока он меньше STREAM_FRAME_BYTES
+# и первый токен кадра ждет не дольше STREAM_FRAME_DELAY секунд
+STREAM_FRAME_BYTES = 256
+STREAM_FRAME_DELAY = 0.05
+# Сколько секунд завершенный ответ доступен для дочитывания после обрыва
+STREAM_RESUME_TTL = 5 * 60
+# gzip для клиентов с Accept-Encoding: gzip
+STREAM_COMPRESSION = True
+# Потоки, в которых крутится генерация (LLM-стрим блокирующий)
+STREAM_WORKERS = 16
+
+
+class ResponseStream:
+    """
+    Tokens of one generated answer. Generation runs in a worker thread and appends
+    tokens here; any number of connections read them, so a dropped client can
+    reattach and continue from the last token it received.
+    """
+
+    def __init__(self, owner: Tuple[str, str]):
+        self.stream_id = uuid.uuid4().hex
+        self.owner = owner
+        self.tokens = []
+        self.done = False
+        self.error = None
+        self.finished_at = None
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    def _notify(self):
+        waiters, self._waiters = self._waiters, []
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # цикл событий клиента уже закрыт
+                pass
+
+    def append(self, token: str):
+        with self._lock:
+            self.tokens.append(token)
+            self._notify()
+
+    def finish(self, error: Optional[Exception] = None):
+        with self._lock:
+            self.done = True
+            self.error = error
+            self.finished_at = time.monotonic()
+            self._notify()
+
+    def poll(self, position: int):
+        """
+        Return (new tokens, done, event). The event is set by the producer on the
+        next append and is only returned when there is nothing to read yet.
+        """
+        with self._lock:
+            tokens = self.tokens[position:]
+            if tokens or self.done:
+                return tokens, self.done, None
+            event = asyncio.Event()
+            self._waiters.append((asyncio.get_running_loop(), event))
+            return tokens, False, event
+
+
+_streams = {}
+_streams_lock = threading.Lock()
+_stream_pool = ThreadPoolExecutor(max_workers=STREAM_WORKERS, thread_name_prefix="stream")
+
+
+def _expire_streams():
+    now = time.monotonic()
+    with _streams_lock:
+        for stream_id, stream in list(_streams.items()):
+            if stream.done and now - stream.finished_at > STREAM_RESUME_TTL:
+                del _streams[stream_id]
+
+
+def _produce(stream: ResponseStream, tokens: Iterable[str], on_complete: Callable[[str], None]):
+    try:
+        for token in tokens:
+            stream.append(token)
+    except Exception as e:
+        print(f"Stream {stream.stream_id} failed: {e}")
+        stream.finish(e)
+        return
+    stream.finish()
+    # История пополняется здесь, после отдачи ответа, а не в генераторе клиента
+    on_complete("".join(stream.tokens))
+
+
+def start_stream(owner: Tuple[str, str], tokens: Iterable[str], on_complete: Callable[[str], None]) -> ResponseStream:
+    """
+    Run a token generator in the background and return the stream readers attach to.
+    `on_complete` receives the full answer once generation succeeds.
+    """
+    _expire_streams()
+    stream = ResponseStream(owner)
+    with _streams_lock:
+        _streams[stream.stream_id] = stream
+    _stream_pool.submit(_produce, stream, tokens, on_complete)
+    return stream
+
+
+def get_stream(stream_id: str) -> Optional[ResponseStream]:
+    with _streams_lock:
+        return _streams.get(stream_id)
+
+
+def parse_event_id(event_id: str) -> Tuple[str, int]:
+    """
+    Split an SSE event id "<stream_id>:<token position>". Raises ValueError when malformed.
+    """
+    stream_id, position = event_id.rsplit(":", 1)
+    return stream_id, int(position)
+
+
+async def coalesce(stream: ResponseStream, position: int = 0) -> AsyncIterator[Tuple[int, str]]:
+    """
+    Group tokens into frames on a size/time threshold.
+    Yields (position after the frame, frame text).
+    """
+    loop = asyncio.get_running_loop()
+    pending = []
+    pending_bytes = 0
+    deadline = None
+
+    while True:
+        tokens, done, event = stream.poll(position)
+        if tokens:
+            if not pending:
+                deadline = loop.time() + STREAM_FRAME_DELAY
+            pending.extend(tokens)
+            pending_bytes += sum(len(token.encode()) for token in tokens)
+            position += len(tokens)
+
+        if pending and (done or pending_bytes >= STREAM_FRAME_BYTES or loop.time() >= deadline):
+            yield position, "".join(pending)
+            pending, pending_bytes = [], 0
+
+        if done:
+            return
+        if event is None:
+            continue
+
+        timeout = max(0.0, deadline - loop.time()) if pending else None
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def text_frames(stream: ResponseStream, position: int = 0) -> AsyncIterator[str]:
+    async for _, frame in coalesce(stream, position):
+        yield frame
+
+
+async def sse_frames(stream: ResponseStream, position: int = 0) -> AsyncIterator[str]:
+    """
+    Server-Sent Events. Every frame carries an id the client sends back as
+    Last-Event-ID to resume after a dropped connection.
+    """
+    if position == 0:
+        yield "retry: 1000\n\n"
+    async for end, frame in coalesce(stream, position):
+        data = "\n".join(f"data: {line}" for line in frame.split("\n"))
+        yield f"id: {stream.stream_id}:{end}\n{data}\n\n"
+    if stream.error is not None:
+        yield "event: error\ndata: generation failed\n\n"
+    else:
+        yield "event: end\ndata: \n\n"
+
+
+async def gzip_frames(frames: AsyncIterator[str]) -> AsyncIterator[bytes]:
+    """
+    Compress frames as one gzip stream, flushing after each frame so it reaches the client immediately.
+    """
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    async for frame in frames:
+        yield compressor.compress(frame.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()